@@ -0,0 +1,123 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import sqlite3
+import json_utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS classifications (
+    doc_id TEXT PRIMARY KEY,
+    name TEXT,
+    categories TEXT NOT NULL,
+    overall_confidence INTEGER NOT NULL,
+    classified_at TEXT NOT NULL,
+    summary TEXT,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS classification_categories (
+    doc_id TEXT NOT NULL,
+    category TEXT NOT NULL,
+    PRIMARY KEY (doc_id, category)
+);
+"""
+
+# Columns returned for reports and samples; the full result is fetched separately
+SUMMARY_COLUMNS = "doc_id, name, categories, overall_confidence, classified_at, summary"
+
+class ClassificationIndex:
+    """Local SQLite index of the classifications written to Google Drive."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        
+        # Indexes created before full results were stored lack the result column
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(classifications)")}
+        if 'result' not in columns:
+            self.conn.execute("ALTER TABLE classifications ADD COLUMN result TEXT")
+
+    def record(self, entries: Iterable[Tuple[str, Optional[str], Dict, str]]):
+        """
+        Insert or update classifications in a single transaction.
+        
+        Args:
+            entries: (document_id, name, classification, classified_at) tuples;
+                a name of None keeps the one already indexed
+        """
+        with self.conn:
+            for doc_id, name, classification, classified_at in entries:
+                categories = list(dict.fromkeys(c['name'] for c in classification['categories']))
+                self.conn.execute(
+                    "INSERT INTO classifications "
+                    "(doc_id, name, categories, overall_confidence, classified_at, summary, result) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(doc_id) DO UPDATE SET "
+                    "name = COALESCE(excluded.name, classifications.name), "
+                    "categories = excluded.categories, "
+                    "overall_confidence = excluded.overall_confidence, "
+                    "classified_at = excluded.classified_at, "
+                    "summary = excluded.summary, "
+                    "result = excluded.result",
+                    (
+                        doc_id,
+                        name,
+                        ','.join(categories),
+                        int(classification['overall_confidence']),
+                        classified_at,
+                        classification['summary'],
+                        json_utils.dumps(classification)
+                    )
+                )
+                self.conn.execute(
+                    "DELETE FROM classification_categories WHERE doc_id = ?",
+                    (doc_id,)
+                )
+                self.conn.executemany(
+                    "INSERT INTO classification_categories (doc_id, category) VALUES (?, ?)",
+                    [(doc_id, category) for category in categories]
+                )
+
+    def get_result(self, doc_id: str) -> Optional[Dict]:
+        """Return the full classification result stored for a document."""
+        row = self.conn.execute(
+            "SELECT result FROM classifications WHERE doc_id = ?",
+            (doc_id,)
+        ).fetchone()
+        return json_utils.loads(row[0]) if row and row[0] else None
+
+    def known_ids(self) -> Set[str]:
+        """Return the IDs of every classified document."""
+        return {row[0] for row in self.conn.execute("SELECT doc_id FROM classifications")}
+
+    def count(self) -> int:
+        """Return the number of classified documents."""
+        return self.conn.execute("SELECT COUNT(*) FROM classifications").fetchone()[0]
+
+    def category_counts(self) -> List[Tuple[str, int]]:
+        """Return (category, document count) pairs, most common first."""
+        return self.conn.execute(
+            "SELECT category, COUNT(*) FROM classification_categories "
+            "GROUP BY category ORDER BY COUNT(*) DESC, category"
+        ).fetchall()
+
+    def confidence_counts(self) -> List[Tuple[int, int]]:
+        """Return (overall confidence, document count) pairs."""
+        return self.conn.execute(
+            "SELECT overall_confidence, COUNT(*) FROM classifications "
+            "GROUP BY overall_confidence"
+        ).fetchall()
+
+    def iter_classifications(self) -> Iterator[sqlite3.Row]:
+        """Iterate over every indexed classification."""
+        return self.conn.execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM classifications ORDER BY classified_at"
+        )
+
+    def sample(self, size: int) -> List[sqlite3.Row]:
+        """Return up to size classifications chosen at random."""
+        # Only rowids pass through the bounded top-k sorter; full rows are
+        # read for the chosen documents alone
+        return self.conn.execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM classifications WHERE rowid IN "
+            "(SELECT rowid FROM classifications ORDER BY RANDOM() LIMIT ?)",
+            (size,)
+        ).fetchall()
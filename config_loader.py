@@ -1,7 +1,11 @@
 import json
 import os
-from typing import Dict, Any
-from pydantic import BaseModel, Field
+from typing import Dict, Any, Optional
+from pydantic import BaseModel, Field, field_validator
+
+# Upper bound on documents packed into a single classification request: each
+# result needs roughly 200 output tokens and the model returns at most 4096
+MAX_BATCH_SIZE = 20
 
 class ConfidenceThresholds(BaseModel):
     high: int = Field(default=90, ge=0, le=100)
@@ -9,9 +13,24 @@ class ConfidenceThresholds(BaseModel):
     low: int = Field(default=0, ge=0, le=100)
 
 class ProcessingConfig(BaseModel):
-    batch_size: int = Field(default=100, ge=1)
+    batch_size: int = Field(default=MAX_BATCH_SIZE, ge=1)
     max_retries: int = Field(default=3, ge=0)
+    max_parallel_requests: int = Field(default=10, ge=1)
+    # Tokens of document content sent to the LLM per document
+    max_content_tokens: int = Field(default=1000, ge=1)
     cache_duration_days: int = Field(default=7, ge=1)
+    cache_enabled: bool = True
+    cache_dir: str = ".cache/llm"
+    content_cache_dir: str = ".cache/content"
+    index_path: str = "classifications.db"
+    # Requests with more documents than this go through the OpenAI Batch API
+    batch_api_threshold: Optional[int] = Field(default=None, ge=1)
+
+    @field_validator('batch_size')
+    @classmethod
+    def _clamp_batch_size(cls, value):
+        # Older configs used up to 100; clamp them rather than refuse to load
+        return min(value, MAX_BATCH_SIZE)
 
 class ReportingConfig(BaseModel):
     sample_size_percent: int = Field(default=10, ge=1, le=100)
@@ -51,9 +70,15 @@ class ConfigLoader:
                     "low": 0
                 },
                 "processing": {
-                    "batch_size": 100,
+                    "batch_size": 20,
                     "max_retries": 3,
-                    "cache_duration_days": 7
+                    "max_parallel_requests": 10,
+                    "max_content_tokens": 1000,
+                    "cache_duration_days": 7,
+                    "cache_enabled": True,
+                    "cache_dir": ".cache/llm",
+                    "content_cache_dir": ".cache/content",
+                    "index_path": "classifications.db"
                 },
                 "reporting": {
                     "sample_size_percent": 10,
@@ -1,21 +1,130 @@
-from typing import Dict, List, Optional
-import json
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import os
-from openai import OpenAI
+import random
+from bisect import bisect_right
+from functools import cached_property
+import httpx
+import tiktoken
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from pydantic import BaseModel, Field, ValidationError, field_validator
+import json_utils
 from config_loader import Config
+from llm_cache import LLMCache
+
+MODEL = "gpt-4-turbo-preview"
+MODEL_CONTEXT_TOKENS = 128000
+MAX_OUTPUT_TOKENS = 4096
+# Allowance for the user message instructions and message framing
+PROMPT_OVERHEAD_TOKENS = 100
+# Allowance for each document's markers and metadata
+DOCUMENT_OVERHEAD_TOKENS = 200
+# Rubric fields the model needs in order to classify
+RUBRIC_CATEGORY_FIELDS = ('name', 'description', 'patterns', 'keywords')
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Transient failures worth retrying; APIConnectionError includes timeouts
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+# Confidence level labels, ordered from lowest to highest threshold
+CONFIDENCE_LEVELS = ('LOW', 'MEDIUM', 'HIGH')
+
+# (document_id, content, metadata) as accepted by classify_documents
+BatchItem = Tuple[str, str, Optional[Dict]]
+
+class CategoryResult(BaseModel):
+    name: str
+    confidence: int = Field(ge=0, le=100)
+    reasoning: str = ""
+
+    @field_validator('confidence', mode='before')
+    @classmethod
+    def _round_confidence(cls, value):
+        # JSON mode does not stop the model from returning fractional scores
+        return round(value) if isinstance(value, float) else value
+
+class ClassificationResult(BaseModel):
+    id: str
+    categories: List[CategoryResult]
+    overall_confidence: int = Field(ge=0, le=100)
+    summary: str
+
+    @field_validator('overall_confidence', mode='before')
+    @classmethod
+    def _round_confidence(cls, value):
+        return round(value) if isinstance(value, float) else value
+
+    @field_validator('id', mode='before')
+    @classmethod
+    def _coerce_id(cls, value):
+        return str(value)
 
 class DocumentClassifier:
     def __init__(self, config: Config):
         self.config = config
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
         self.rubric = self._load_rubric()
+        # Plain attributes avoid the pydantic attribute chain on per-document paths
+        self._conf_breaks = (config.confidence_thresholds.medium, config.confidence_thresholds.high)
+        self._max_retries = config.processing.max_retries
+        self._max_content_tokens = config.processing.max_content_tokens
+        self._rubric_serialized = json_utils.dumps(self._compact_rubric())
+        self._system_prompt = self._get_system_prompt()
+        self._encoding = tiktoken.encoding_for_model(MODEL)
+        self._prompt_tokens = (
+            len(self._encoding.encode_ordinary(self._system_prompt))
+            + PROMPT_OVERHEAD_TOKENS
+        )
+        self.cache = None
+        self.temperature = 0.3
+        if config.processing.cache_enabled:
+            self.cache = LLMCache(
+                config.processing.cache_dir,
+                ttl=config.processing.cache_duration_days * 86400
+            )
+            # Cached answers are only reusable if they are deterministic
+            self.temperature = 0
+        # Hash of the request parts shared by every document
+        self._cache_namespace = LLMCache.make_key(
+            MODEL,
+            self._system_prompt,
+            str(self.temperature)
+        )
+
+    @cached_property
+    def client(self) -> AsyncOpenAI:
+        """OpenAI client, created on first use and reused for every request."""
+        # Concurrent workers multiplex their requests over shared HTTP/2 connections
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            # A full batch can take minutes to generate; only connecting should fail fast
+            timeout=httpx.Timeout(600, connect=10)
+        )
+        # Retries are handled by _create_completion; the SDK's own would multiply them
+        return AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=http_client,
+            max_retries=0
+        )
+
+    @cached_property
+    def batch_client(self) -> AsyncOpenAI:
+        """Client for Batch API file and batch calls, which keep the SDK's retries."""
+        return self.client.with_options(max_retries=self._max_retries)
 
     def _load_rubric(self) -> dict:
         """Load the classification rubric from the configured path."""
-        with open(self.config.rubric_path, 'r') as f:
-            return json.load(f)
+        with open(self.config.rubric_path, 'rb') as f:
+            return json_utils.loads(f.read())
+
+    def _compact_rubric(self) -> dict:
+        """Reduce the rubric to the category fields used for classification."""
+        return {
+            "categories": [
+                {field: category[field] for field in RUBRIC_CATEGORY_FIELDS if field in category}
+                for category in self.rubric.get('categories', [])
+            ]
+        }
 
-    def classify_document(self, content: str, metadata: Optional[Dict] = None) -> Dict:
+    async def classify_document(self, content: str, metadata: Optional[Dict] = None) -> Dict:
         """
         Classify a document using the LLM based on the rubric.
         
@@ -26,126 +135,340 @@ class DocumentClassifier:
         Returns:
             Dictionary containing classification results
         """
-        # Prepare the prompt
-        prompt = self._build_classification_prompt(content, metadata)
+        return (await self.classify_documents([("0", content, metadata)]))["0"]
+
+    async def classify_documents(self, items: List[BatchItem]) -> Dict[str, Dict]:
+        """
+        Classify several documents with a single LLM call.
+        
+        Documents with a cached classification are answered from the cache
+        and left out of the request.
+        
+        Args:
+            items: List of (document_id, content, metadata) tuples
+            
+        Returns:
+            Dictionary mapping each document ID to its classification results
+        """
+        classifications = {}
+        misses = []
+        
+        for item in self._truncate_items(items):
+            key = self._cache_key(item)
+            cached = self.cache.get(key) if self.cache else None
+            if cached is not None:
+                classifications[item[0]] = self._add_confidence_levels(cached)
+            else:
+                misses.append((key, item))
+        
+        if misses:
+            fresh = await self._request_classifications([item for _, item in misses])
+            for key, (doc_id, _, _) in misses:
+                classification = fresh[doc_id]
+                if self.cache and 'error' not in classification:
+                    self.cache.set(key, classification)
+                classifications[doc_id] = classification
+                
+        return classifications
+
+    async def _request_classifications(self, items: List[BatchItem]) -> Dict[str, Dict]:
+        """Classify documents with a single chat completion request."""
+        doc_ids = [doc_id for doc_id, _, _ in items]
         
         try:
             # Get classification from LLM
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": self._get_system_prompt()},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=1000
-            )
+            response = await self._create_completion(self._build_request_body(items))
+            choice = response.choices[0]
+            
+            # A response cut off at max_tokens is unparseable JSON, so split the
+            # batch and classify each half separately
+            if choice.finish_reason == "length" and len(items) > 1:
+                half = len(items) // 2
+                first = await self._request_classifications(items[:half])
+                second = await self._request_classifications(items[half:])
+                return {**first, **second}
             
             # Parse the response
-            classification = self._parse_classification_response(response.choices[0].message.content)
+            classifications = self._parse_classification_response(
+                choice.message.content, doc_ids
+            )
             
             # Add confidence scores
-            classification = self._add_confidence_levels(classification)
-            
-            return classification
+            return {
+                doc_id: self._add_confidence_levels(classification)
+                for doc_id, classification in classifications.items()
+            }
             
         except Exception as e:
             print(f"Error during classification: {e}")
             return {
-                "error": str(e),
+                doc_id: {
+                    "error": str(e),
+                    "categories": [],
+                    "confidence": 0
+                }
+                for doc_id in doc_ids
+            }
+
+    async def submit_batch(self, items: List[BatchItem]) -> str:
+        """
+        Submit documents for offline classification through the OpenAI Batch API.
+        
+        Args:
+            items: List of (document_id, content, metadata) tuples
+            
+        Returns:
+            ID of the created batch, to be passed to poll_batch
+        """
+        # Each line is its own request, so every document gets a full budget
+        # rather than a share of one packed prompt
+        lines = []
+        for item in items:
+            request_items = self._truncate_items([item])
+            lines.append(json_utils.dumps({
+                "custom_id": item[0],
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": self._build_request_body(request_items)
+            }))
+        batch_file = await self.batch_client.files.create(
+            file=("classification_batch.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = await self.batch_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h"
+        )
+        return batch.id
+
+    async def poll_batch(self, batch_id: str) -> Tuple[str, Optional[Dict[str, Dict]]]:
+        """
+        Check a submitted batch and collect its results once it has completed.
+        
+        Args:
+            batch_id: ID returned by submit_batch
+            
+        Returns:
+            Tuple of the batch status and, when completed, a dictionary mapping
+            each document ID to its classification results
+        """
+        batch = await self.batch_client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return batch.status, None
+        
+        classifications = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            output = await self.batch_client.files.content(file_id)
+            for line in output.text.splitlines():
+                if line.strip():
+                    record = json_utils.loads(line)
+                    classifications[record['custom_id']] = self._parse_batch_record(record)
+                    
+        return batch.status, classifications
+
+    def _parse_batch_record(self, record: Dict) -> Dict:
+        """Turn one line of a Batch API output file into a classification."""
+        doc_id = record['custom_id']
+        response = record.get('response') or {}
+        if record.get('error') or response.get('status_code') != 200:
+            error = record.get('error') or response.get('body', {}).get('error')
+            return {
+                "error": str(error),
                 "categories": [],
                 "confidence": 0
             }
+        
+        try:
+            content = response['body']['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError) as e:
+            print(f"Error parsing classification response: {e}")
+            return self._add_confidence_levels(self._parse_error(e))
+        
+        classification = self._parse_classification_response(content, [doc_id])[doc_id]
+        return self._add_confidence_levels(classification)
+
+    async def _create_completion(self, body: Dict):
+        """Call the chat completions endpoint, backing off exponentially on transient errors."""
+        max_retries = self._max_retries
+        for attempt in range(max_retries + 1):
+            try:
+                return await self.client.chat.completions.create(**body)
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = self._retry_after(e)
+                await asyncio.sleep(delay if delay is not None else 2 ** attempt + random.random())
+
+    def _retry_after(self, error: Exception) -> Optional[float]:
+        """Return the delay in seconds requested by the server's Retry-After header, if any."""
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        try:
+            return max(float(response.headers.get('retry-after')), 0)
+        except (TypeError, ValueError):
+            # Missing, or given as an HTTP date
+            return None
 
-    def _build_classification_prompt(self, content: str, metadata: Optional[Dict] = None) -> str:
-        """Build the prompt for document classification."""
+    def _build_request_body(self, items: List[BatchItem]) -> Dict:
+        """Build the chat completion parameters for classifying the given documents."""
+        return {
+            "model": MODEL,
+            "messages": [
+                {"role": "system", "content": self._system_prompt},
+                {"role": "user", "content": self._build_batch_prompt(items)}
+            ],
+            "temperature": self.temperature,
+            "response_format": {"type": "json_object"},
+            "max_tokens": min(MAX_OUTPUT_TOKENS, 1000 * len(items))
+        }
+
+    def _truncate_items(self, items: List[BatchItem]) -> List[BatchItem]:
+        """Truncate each document's content to its share of the context window."""
+        if not items:
+            return items
+        available = MODEL_CONTEXT_TOKENS - self._prompt_tokens - MAX_OUTPUT_TOKENS
+        budget = max(1, min(
+            self._max_content_tokens,
+            available // len(items) - DOCUMENT_OVERHEAD_TOKENS
+        ))
+        return [
+            (doc_id, self._truncate(content, budget), metadata)
+            for doc_id, content, metadata in items
+        ]
+
+    def _truncate(self, content: str, max_tokens: int) -> str:
+        """Truncate content to at most max_tokens tokens."""
+        # Tokens rarely span more than a few characters, so only encode a
+        # prefix rather than the whole of a large document
+        prefix = content[:max_tokens * 8]
+        tokens = self._encoding.encode_ordinary(prefix)
+        if len(tokens) <= max_tokens:
+            return prefix
+        return self._encoding.decode(tokens[:max_tokens])
+
+    def _cache_key(self, item: BatchItem) -> str:
+        """Build the response cache key for a single document."""
+        _, content, metadata = item
+        return LLMCache.make_key(
+            self._cache_namespace,
+            content,
+            json_utils.dumps(metadata, sort_keys=True)
+        )
+
+    def _build_batch_prompt(self, items: List[BatchItem]) -> str:
+        """Build the prompt for classifying a batch of documents."""
         prompt_parts = [
-            "Please classify the following document according to the provided rubric.",
-            "\nDocument content:",
-            content[:4000]  # Limit content length
+            "Please classify each of the following documents according to the provided rubric."
         ]
         
-        if metadata:
+        for doc_id, content, metadata in items:
             prompt_parts.extend([
-                "\nDocument metadata:",
-                json.dumps(metadata, indent=2)
+                f"\n<<<DOC id={doc_id}>>>",
+                content
             ])
-            
-        prompt_parts.extend([
-            "\nClassification rubric:",
-            json.dumps(self.rubric, indent=2),
-            "\nPlease provide the classification in JSON format with the following structure:",
-            """{
-                "categories": [
-                    {
-                        "name": "category_name",
-                        "confidence": 0-100,
-                        "reasoning": "explanation"
-                    }
-                ],
-                "overall_confidence": 0-100,
-                "summary": "brief classification summary"
-            }"""
-        ])
+            if metadata:
+                prompt_parts.extend([
+                    "\nDocument metadata:",
+                    json_utils.dumps(metadata)
+                ])
+            prompt_parts.append("<<<END>>>")
         
         return "\n".join(prompt_parts)
 
     def _get_system_prompt(self) -> str:
-        """Get the system prompt for the LLM."""
-        return """You are a document classification expert. Your task is to:
+        """
+        Get the system prompt for the LLM.
+        
+        Everything that is the same for every request lives here, so the
+        prompt prefix is byte-identical across calls and can be served from
+        the provider's prompt cache.
+        """
+        return "\n".join([
+            """You are a document classification expert. Your task is to:
 1. Analyze document content and metadata
 2. Match it against the provided classification rubric
 3. Return structured classification results
 4. Provide confidence scores and reasoning
-Be precise and follow the rubric exactly."""
+Be precise and follow the rubric exactly.""",
+            "\nClassification rubric:",
+            self._rubric_serialized,
+            "\nEvery document is enclosed between a <<<DOC id=...>>> marker and a <<<END>>> marker.",
+            "Provide the classification of every document in JSON format with the following structure:",
+            """{
+                "results": [
+                    {
+                        "id": "document id from the DOC marker",
+                        "categories": [
+                            {
+                                "name": "category_name",
+                                "confidence": 0-100,
+                                "reasoning": "one sentence explanation"
+                            }
+                        ],
+                        "overall_confidence": 0-100,
+                        "summary": "brief classification summary"
+                    }
+                ]
+            }"""
+        ])
 
-    def _parse_classification_response(self, response: str) -> Dict:
-        """Parse the LLM's response into a structured format."""
+    def _parse_classification_response(self, response: str, doc_ids: List[str]) -> Dict[str, Dict]:
+        """Parse the LLM's JSON response into a structured result per document ID."""
         try:
-            # Extract JSON from response (handle potential text before/after JSON)
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            json_str = response[start:end]
-            
-            # Parse the JSON
-            classification = json.loads(json_str)
-            
-            # Validate required fields
-            required_fields = ['categories', 'overall_confidence', 'summary']
-            for field in required_fields:
-                if field not in classification:
-                    raise ValueError(f"Missing required field: {field}")
-            
-            return classification
-            
+            results = json_utils.loads(response)['results']
+            # JSON mode guarantees valid JSON, not the expected shape
+            if not isinstance(results, list):
+                raise ValueError(f"Expected a list of results, got {type(results).__name__}")
         except Exception as e:
             print(f"Error parsing classification response: {e}")
-            return {
-                "categories": [],
-                "overall_confidence": 0,
-                "summary": "Error parsing classification",
-                "error": str(e)
-            }
+            return {doc_id: self._parse_error(e) for doc_id in doc_ids}
+
+        # Validate each entry on its own so one malformed result only fails its document
+        by_id = {}
+        for result in results:
+            try:
+                classification = ClassificationResult.model_validate(result)
+                by_id[classification.id] = classification.model_dump(exclude={'id'})
+            except ValidationError as e:
+                if isinstance(result, dict) and 'id' in result:
+                    by_id[str(result['id'])] = e
+
+        classifications = {}
+        for doc_id in doc_ids:
+            result = by_id.get(doc_id)
+            if result is None:
+                result = ValueError(f"No classification returned for document {doc_id}")
+            if isinstance(result, Exception):
+                print(f"Error parsing classification response: {result}")
+                result = self._parse_error(result)
+            classifications[doc_id] = result
+                
+        return classifications
+
+    def _parse_error(self, error: Exception) -> Dict:
+        """Build the placeholder classification for an unparseable result."""
+        return {
+            "categories": [],
+            "overall_confidence": 0,
+            "summary": "Error parsing classification",
+            "error": str(error)
+        }
 
     def _add_confidence_levels(self, classification: Dict) -> Dict:
         """Add confidence level labels based on configured thresholds."""
-        thresholds = self.config.confidence_thresholds
-        
-        def get_confidence_level(score: int) -> str:
-            if score >= thresholds.high:
-                return "HIGH"
-            elif score >= thresholds.medium:
-                return "MEDIUM"
-            else:
-                return "LOW"
+        breaks = self._conf_breaks
         
         # Add confidence levels to categories
         for category in classification['categories']:
-            category['confidence_level'] = get_confidence_level(category['confidence'])
+            category['confidence_level'] = CONFIDENCE_LEVELS[bisect_right(breaks, category['confidence'])]
         
         # Add overall confidence level
-        classification['overall_confidence_level'] = get_confidence_level(
-            classification['overall_confidence']
-        )
+        classification['overall_confidence_level'] = CONFIDENCE_LEVELS[
+            bisect_right(breaks, classification['overall_confidence'])
+        ]
         
         return classification
\ No newline at end of file
@@ -1,27 +1,19 @@
 from typing import List, Optional
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import os
-import json
-from datetime import datetime, timedelta
+from datetime import datetime
 from config_loader import Config
+from google_services import ServiceBundle, classification_properties
+from classification_index import ClassificationIndex
 
 class DocumentDiscovery:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, services: ServiceBundle, index: ClassificationIndex):
         self.config = config
-        self.credentials = self._load_credentials()
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        self.services = services
+        self.index = index
 
-    def _load_credentials(self) -> Credentials:
-        # Load credentials from the OAuth token file
-        token_path = os.getenv('GOOGLE_TOKEN_PATH', 'token.json')
-        if not os.path.exists(token_path):
-            raise FileNotFoundError(f"Google OAuth token not found at {token_path}")
-        
-        with open(token_path, 'r') as token:
-            token_data = json.load(token)
-            return Credentials.from_authorized_user_info(token_data)
+    @property
+    def service(self):
+        return self.services.drive_service
 
     def discover_documents(
         self,
@@ -53,12 +45,12 @@ class DocumentDiscovery:
                 mime_types = [f"mimeType = '{mime}'" for mime in file_types]
                 query_parts.append(f"({' or '.join(mime_types)})")
             
-            # Exclude already processed files (using a custom property)
-            query_parts.append("not properties has { key='classified' and value='true' }")
-            
             # Combine all query parts
             query = " and ".join(query_parts) if query_parts else None
             
+            # Already classified documents are excluded client-side using the index
+            known_ids = self.index.known_ids()
+            
             # Execute the search
             results = []
             page_token = None
@@ -69,10 +61,10 @@ class DocumentDiscovery:
                     spaces='drive',
                     fields='nextPageToken, files(id, name, mimeType, createdTime, modifiedTime, owners, size)',
                     pageToken=page_token,
-                    pageSize=min(100, max_documents - len(results))
+                    pageSize=100
                 ).execute()
                 
-                results.extend(response.get('files', []))
+                results.extend(f for f in response.get('files', []) if f['id'] not in known_ids)
                 
                 if len(results) >= max_documents:
                     results = results[:max_documents]
@@ -92,17 +84,13 @@ class DocumentDiscovery:
         """
         Mark a document as processed with its classification result.
         """
+        classified_at = datetime.now().isoformat()
         try:
             # Update the file's properties
             self.service.files().update(
                 fileId=document_id,
-                body={
-                    'properties': {
-                        'classified': 'true',
-                        'classification_date': datetime.now().isoformat(),
-                        'classification_result': json.dumps(classification_result)
-                    }
-                }
+                body={'properties': classification_properties(classification_result, classified_at)}
             ).execute()
+            self.index.record([(document_id, None, classification_result, classified_at)])
         except HttpError as error:
             print(f'Error marking document as processed: {error}')
\ No newline at end of file
@@ -1,30 +1,48 @@
-from typing import List, Dict, Optional
-import json
-import os
+from typing import Iterator, List, Dict, Optional, Tuple
+import asyncio
+import io
+from bisect import bisect_right
+from collections import Counter
 from datetime import datetime
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from config_loader import Config
-from document_classifier import DocumentClassifier
-import random
+from functools import cached_property
+import diskcache
+from googleapiclient.http import HttpRequest
+import json_utils
+from config_loader import Config, MAX_BATCH_SIZE
+from document_classifier import DocumentClassifier, CONFIDENCE_LEVELS
+from google_services import ServiceBundle, classification_properties
+from classification_index import ClassificationIndex
+
+# Drive accepts at most this many calls in one batch HTTP request
+DRIVE_BATCH_LIMIT = 100
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
 
 class DocumentProcessor:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, services: ServiceBundle, index: ClassificationIndex):
         self.config = config
-        self.classifier = DocumentClassifier(config)
-        self.credentials = self._load_credentials()
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        self.services = services
+        self.index = index
+        # Plain attributes avoid the pydantic attribute chain on per-document paths
+        self._conf_breaks = (config.confidence_thresholds.medium, config.confidence_thresholds.high)
+        self._batch_size = config.processing.batch_size
+        self._max_parallel_requests = config.processing.max_parallel_requests
+        self._cache_ttl = config.processing.cache_duration_days * 86400
+        # Extracted document text keyed by (document ID, modified time). Built
+        # here because it is first used from worker threads
+        self.content_cache: Optional[diskcache.Cache] = (
+            diskcache.Cache(config.processing.content_cache_dir)
+            if config.processing.cache_enabled else None
+        )
 
-    def _load_credentials(self) -> Credentials:
-        token_path = os.getenv('GOOGLE_TOKEN_PATH', 'token.json')
-        if not os.path.exists(token_path):
-            raise FileNotFoundError(f"Google OAuth token not found at {token_path}")
-        
-        with open(token_path, 'r') as token:
-            token_data = json.load(token)
-            return Credentials.from_authorized_user_info(token_data)
+    @cached_property
+    def classifier(self) -> DocumentClassifier:
+        return DocumentClassifier(self.config)
+
+    @property
+    def service(self):
+        return self.services.drive_service
 
-    def process_documents(
+    async def process_documents(
         self,
         document_ids: List[str],
         batch_size: Optional[int] = None
@@ -39,175 +57,314 @@ class DocumentProcessor:
         Returns:
             List of classification results
         """
-        batch_size = batch_size or self.config.processing.batch_size
-        results = []
+        batch_size = min(batch_size or self._batch_size, MAX_BATCH_SIZE)
+        sem = asyncio.Semaphore(self._max_parallel_requests)
+        
+        batches = [
+            document_ids[i:i + batch_size]
+            for i in range(0, len(document_ids), batch_size)
+        ]
         
-        # Process documents in batches
-        for i in range(0, len(document_ids), batch_size):
-            batch = document_ids[i:i + batch_size]
-            batch_results = self._process_batch(batch)
-            results.extend(batch_results)
+        # Process documents in concurrent batches; a failing batch must not
+        # discard the results of the others
+        batch_results = await asyncio.gather(*[
+            self._process_batch(batch, sem) for batch in batches
+        ], return_exceptions=True)
+        
+        results = []
+        for batch, batch_result in zip(batches, batch_results):
+            if isinstance(batch_result, Exception):
+                print(f"Error processing batch: {batch_result}")
+                batch_result = [self._failure_result(doc_id, batch_result) for doc_id in batch]
+            results.extend(batch_result)
             
         return results
 
-    def _process_batch(self, document_ids: List[str]) -> List[Dict]:
-        """Process a batch of documents."""
-        results = []
+    async def submit_classification_batch(self, document_ids: List[str]) -> Dict:
+        """
+        Submit documents for offline classification through the OpenAI Batch API.
         
-        for doc_id in document_ids:
-            try:
-                # Get document content and metadata
-                content, metadata = self._get_document_content(doc_id)
-                
-                # Classify the document
-                classification = self.classifier.classify_document(content, metadata)
+        Args:
+            document_ids: List of Google Drive document IDs
+            
+        Returns:
+            The batch ID along with any documents that could not be fetched
+        """
+        sem = asyncio.Semaphore(self._max_parallel_requests)
+        items, failures = await self._fetch_documents(document_ids, sem)
+        batch_id = await self.classifier.submit_batch(items) if items else None
+        
+        return {
+            'batch_id': batch_id,
+            'submitted': [doc_id for doc_id, _, _ in items],
+            'failed': failures
+        }
+
+    async def fetch_classification_batch(self, batch_id: str) -> Dict:
+        """
+        Collect the results of a batch submitted with submit_classification_batch.
+        
+        Args:
+            batch_id: ID of the submitted batch
+            
+        Returns:
+            The batch status and, once completed, the classification results
+        """
+        status, classifications = await self.classifier.poll_batch(batch_id)
+        if classifications is None:
+            return {'batch_id': batch_id, 'status': status}
+        
+        sem = asyncio.Semaphore(self._max_parallel_requests)
+        files, _ = await self._get_metadata(list(classifications), sem)
+        return {
+            'batch_id': batch_id,
+            'status': status,
+            'classifications': await self._record_classifications(classifications, files, sem)
+        }
+
+    async def _process_batch(self, document_ids: List[str], sem: asyncio.Semaphore) -> List[Dict]:
+        """Process a batch of documents with a single classification call."""
+        items, failures = await self._fetch_documents(document_ids, sem)
+        results = {result['document_id']: result for result in failures}
+        
+        # Classify all fetched documents at once
+        async with sem:
+            classifications = await self.classifier.classify_documents(items)
+        
+        files = {doc_id: metadata for doc_id, _, metadata in items}
+        recorded = await self._record_classifications(classifications, files, sem)
+        results.update((result['document_id'], result) for result in recorded)
+            
+        return [results[doc_id] for doc_id in document_ids]
+
+    async def _fetch_documents(self, document_ids: List[str], sem: asyncio.Semaphore) -> tuple:
+        """Fetch metadata in batched requests and content concurrently, collecting failures."""
+        files, errors = await self._get_metadata(document_ids, sem)
+        
+        # cached_property has no lock, so build the Docs client here rather
+        # than letting several worker threads race to build it on first use
+        if any(file['mimeType'] == GOOGLE_DOC_MIME_TYPE for file in files.values()):
+            self.services.docs_service
+        
+        # Media downloads cannot be batched, so fetch content in parallel
+        async def worker(file: Dict) -> str:
+            async with sem:
+                return await asyncio.to_thread(self._get_document_content, file)
+        
+        fetched = await asyncio.gather(
+            *[worker(file) for file in files.values()],
+            return_exceptions=True
+        )
+        contents = dict(zip(files, fetched))
+        
+        items = []
+        failures = []
+        for doc_id in dict.fromkeys(document_ids):
+            result = errors[doc_id] if doc_id in errors else contents[doc_id]
+            if isinstance(result, Exception):
+                failures.append(self._failure_result(doc_id, result))
+            else:
+                items.append((doc_id, result, files[doc_id]))
                 
-                # Store the results
-                result = {
+        return items, failures
+
+    async def _get_metadata(self, document_ids: List[str], sem: asyncio.Semaphore) -> Tuple[Dict, Dict]:
+        """Get Drive metadata for documents, returning (files, errors) keyed by document ID."""
+        # Metadata for a whole batch comes back from a single HTTP round-trip
+        requests = {
+            doc_id: self.service.files().get(
+                fileId=doc_id,
+                fields='id, name, mimeType, createdTime, modifiedTime, owners'
+            )
+            for doc_id in document_ids
+        }
+        async with sem:
+            return await self._execute_batch(requests)
+
+    async def _record_classifications(
+        self,
+        classifications: Dict[str, Dict],
+        files: Dict[str, Dict],
+        sem: asyncio.Semaphore
+    ) -> List[Dict]:
+        """Store classifications on their documents and in the index, and build the result entries."""
+        classified_at = datetime.now().isoformat()
+        
+        # Update document properties with classification in batched requests
+        requests = {
+            doc_id: self.service.files().update(
+                fileId=doc_id,
+                body={'properties': classification_properties(classification, classified_at)}
+            )
+            for doc_id, classification in classifications.items()
+            if 'error' not in classification
+        }
+        async with sem:
+            _, errors = await self._execute_batch(requests)
+        
+        self.index.record(
+            (doc_id, files.get(doc_id, {}).get('name'), classifications[doc_id], classified_at)
+            for doc_id in requests
+            if doc_id not in errors
+        )
+        
+        results = []
+        for doc_id, classification in classifications.items():
+            if 'error' in classification:
+                results.append(self._failure_result(doc_id, RuntimeError(classification['error'])))
+            elif doc_id in errors:
+                results.append(self._failure_result(doc_id, errors[doc_id]))
+            else:
+                results.append({
                     'document_id': doc_id,
                     'classification': classification,
                     'processed_at': datetime.now().isoformat(),
                     'success': True
-                }
-                
-                # Update document properties with classification
-                self._update_document_properties(doc_id, classification)
+                })
                 
-            except Exception as e:
-                result = {
-                    'document_id': doc_id,
-                    'error': str(e),
-                    'processed_at': datetime.now().isoformat(),
-                    'success': False
-                }
-            
-            results.append(result)
-            
         return results
 
-    def _get_document_content(self, doc_id: str) -> tuple:
-        """Get document content and metadata from Google Drive."""
-        # Get metadata
-        file = self.service.files().get(
-            fileId=doc_id,
-            fields='id, name, mimeType, createdTime, modifiedTime, owners'
-        ).execute()
+    async def _execute_batch(self, requests: Dict[str, HttpRequest]) -> Tuple[Dict, Dict]:
+        """
+        Execute Drive requests through batch HTTP requests.
+        
+        Args:
+            requests: Requests keyed by a unique request ID
+            
+        Returns:
+            Tuple of responses and exceptions, each keyed by request ID
+        """
+        responses = {}
+        errors = {}
+        
+        def callback(request_id: str, response: Dict, exception: Exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+        
+        request_ids = list(requests)
+        for i in range(0, len(request_ids), DRIVE_BATCH_LIMIT):
+            chunk = request_ids[i:i + DRIVE_BATCH_LIMIT]
+            batch = self.service.new_batch_http_request(callback=callback)
+            for request_id in chunk:
+                batch.add(requests[request_id], request_id=request_id)
+            try:
+                # Look up the HTTP client inside the worker thread so each
+                # thread uses its own httplib2 connection
+                await asyncio.to_thread(lambda: batch.execute(http=self.services.http()))
+            except Exception as e:
+                errors.update((request_id, e) for request_id in chunk)
+                
+        return responses, errors
+
+    def _failure_result(self, doc_id: str, error: Exception) -> Dict:
+        """Build the result entry for a document that could not be processed."""
+        return {
+            'document_id': doc_id,
+            'error': str(error),
+            'processed_at': datetime.now().isoformat(),
+            'success': False
+        }
+
+    def _get_document_content(self, file: Dict) -> str:
+        """Get document content from Google Drive based on its metadata."""
+        # A document's text only changes along with its modified time
+        key = (file['id'], file.get('modifiedTime'))
+        if self.content_cache is not None:
+            content = self.content_cache.get(key)
+            if content is not None:
+                return content
         
         # Get content based on mime type
-        if file['mimeType'] == 'application/vnd.google-apps.document':
-            content = self._get_docs_content(doc_id)
+        if file['mimeType'] == GOOGLE_DOC_MIME_TYPE:
+            content = self._get_docs_content(file['id'])
         else:
-            content = self._get_file_content(doc_id)
-            
-        return content, file
+            content = self._get_file_content(file['id'])
+        
+        if self.content_cache is not None:
+            self.content_cache.set(
+                key,
+                content,
+                expire=self._cache_ttl
+            )
+        return content
 
     def _get_docs_content(self, doc_id: str) -> str:
         """Get content from a Google Doc."""
-        docs_service = build('docs', 'v1', credentials=self.credentials)
-        document = docs_service.documents().get(documentId=doc_id).execute()
+        document = self.services.docs_service.documents().get(
+            documentId=doc_id
+        ).execute(http=self.services.http())
         
-        # Extract text content
-        content = []
-        for elem in document.get('body', {}).get('content', []):
-            if 'paragraph' in elem:
-                for para_elem in elem['paragraph']['elements']:
-                    if 'textRun' in para_elem:
-                        content.append(para_elem['textRun']['content'])
-                        
-        return '\n'.join(content)
+        # Text runs already end with the paragraph's newline
+        return ''.join(self._iter_text(document))
+
+    @staticmethod
+    def _iter_text(document: Dict) -> Iterator[str]:
+        """Yield the text of every text run in a Google Doc body."""
+        for elem in document.get('body', {}).get('content', ()):
+            paragraph = elem.get('paragraph')
+            if paragraph:
+                for para_elem in paragraph['elements']:
+                    text_run = para_elem.get('textRun')
+                    if text_run:
+                        yield text_run['content']
 
     def _get_file_content(self, file_id: str) -> str:
         """Get content from a regular file."""
         request = self.service.files().get_media(fileId=file_id)
-        return request.execute().decode('utf-8')
-
-    def _update_document_properties(self, doc_id: str, classification: Dict):
-        """Update document properties with classification results."""
-        properties = {
-            'classified': 'true',
-            'classification_date': datetime.now().isoformat(),
-            'classification_summary': classification['summary'],
-            'overall_confidence': str(classification['overall_confidence']),
-            'categories': ','.join([c['name'] for c in classification['categories']])
-        }
-        
-        self.service.files().update(
-            fileId=doc_id,
-            body={'properties': properties}
-        ).execute()
+        return request.execute(http=self.services.http()).decode('utf-8')
 
     def generate_report(
         self,
         format: str = "markdown",
         include_details: bool = True
     ) -> str:
-        """Generate a classification report."""
-        # Get all classified documents
-        results = self.service.files().list(
-            q="properties has { key='classified' and value='true' }",
-            fields='files(id, name, properties)'
-        ).execute()
-        
-        files = results.get('files', [])
-        
+        """Generate a classification report from the local index."""
         if format == "markdown":
-            return self._generate_markdown_report(files, include_details)
+            buffer = io.StringIO()
+            buffer.writelines(self._stream_markdown_report(include_details))
+            return buffer.getvalue()
         else:
-            return json.dumps(files, indent=2)
+            return json_utils.dumps(
+                [dict(row) for row in self.index.iter_classifications()],
+                indent=True
+            )
 
-    def _generate_markdown_report(self, files: List[Dict], include_details: bool) -> str:
-        """Generate a markdown format report."""
-        report_parts = [
-            "# Document Classification Report",
-            f"\nGenerated: {datetime.now().isoformat()}",
-            f"\nTotal Documents: {len(files)}",
-            "\n## Summary",
-        ]
+    def _stream_markdown_report(self, include_details: bool) -> Iterator[str]:
+        """Yield a markdown format report chunk by chunk."""
+        yield "# Document Classification Report\n"
+        yield f"\nGenerated: {datetime.now().isoformat()}\n"
+        yield f"\nTotal Documents: {self.index.count()}\n"
+        yield "\n## Summary\n"
         
         # Aggregate statistics
-        categories = {}
-        confidence_levels = {'HIGH': 0, 'MEDIUM': 0, 'LOW': 0}
+        yield "\n### Categories\n"
+        for cat, count in self.index.category_counts():
+            yield f"- {cat}: {count}\n"
         
-        for file in files:
-            props = file.get('properties', {})
-            for cat in props.get('categories', '').split(','):
-                if cat:
-                    categories[cat] = categories.get(cat, 0) + 1
-            
-            confidence = int(props.get('overall_confidence', 0))
-            if confidence >= self.config.confidence_thresholds.high:
-                confidence_levels['HIGH'] += 1
-            elif confidence >= self.config.confidence_thresholds.medium:
-                confidence_levels['MEDIUM'] += 1
-            else:
-                confidence_levels['LOW'] += 1
+        confidence_levels = Counter()
+        for confidence, count in self.index.confidence_counts():
+            confidence_levels[self._confidence_level(confidence)] += count
         
-        # Add statistics to report
-        report_parts.extend([
-            "\n### Categories",
-            *[f"- {cat}: {count}" for cat, count in categories.items()],
-            "\n### Confidence Levels",
-            *[f"- {level}: {count}" for level, count in confidence_levels.items()]
-        ])
+        yield "\n### Confidence Levels\n"
+        for level in reversed(CONFIDENCE_LEVELS):
+            yield f"- {level}: {confidence_levels[level]}\n"
         
         if include_details:
-            report_parts.extend([
-                "\n## Detailed Results",
-                *[self._format_file_details(f) for f in files]
-            ])
-        
-        return "\n".join(report_parts)
+            yield "\n## Detailed Results\n"
+            for row in self.index.iter_classifications():
+                yield self._format_file_details(row)
 
-    def _format_file_details(self, file: Dict) -> str:
-        """Format file details for markdown report."""
-        props = file.get('properties', {})
+    def _format_file_details(self, row: Dict) -> str:
+        """Format an indexed classification for markdown report."""
         return f"""
-### {file['name']}
-- ID: {file['id']}
-- Classification Date: {props.get('classification_date')}
-- Categories: {props.get('categories')}
-- Confidence: {props.get('overall_confidence')}%
-- Summary: {props.get('classification_summary')}
+### {row['name']}
+- ID: {row['doc_id']}
+- Classification Date: {row['classified_at']}
+- Categories: {row['categories']}
+- Confidence: {row['overall_confidence']}%
+- Summary: {row['summary']}
 """
 
     def validate_samples(self, sample_size: int = 100) -> Dict:
@@ -220,55 +377,40 @@ class DocumentProcessor:
         Returns:
             Validation results and statistics
         """
-        # Get all classified documents
-        results = self.service.files().list(
-            q="properties has { key='classified' and value='true' }",
-            fields='files(id, name, properties)'
-        ).execute()
-        
-        files = results.get('files', [])
-        
-        # Take a random sample
-        sample = random.sample(files, min(sample_size, len(files)))
+        # Take a random sample of the indexed classifications
+        sample = self.index.sample(sample_size)
         
         # Analyze the sample
-        validation_results = {
+        confidence_levels = Counter(
+            self._confidence_level(row['overall_confidence']) for row in sample
+        )
+        categories = Counter(
+            category
+            for row in sample
+            for category in row['categories'].split(',')
+            if category
+        )
+        
+        return {
             'sample_size': len(sample),
-            'total_documents': len(files),
+            'total_documents': self.index.count(),
             'confidence_distribution': {
-                'high': 0,
-                'medium': 0,
-                'low': 0
+                level.lower(): confidence_levels[level] for level in reversed(CONFIDENCE_LEVELS)
             },
-            'category_distribution': {},
-            'samples': []
+            'category_distribution': dict(categories),
+            'samples': [
+                {
+                    'id': row['doc_id'],
+                    'name': row['name'],
+                    'confidence': row['overall_confidence'],
+                    'categories': row['categories'].split(','),
+                    'summary': row['summary'],
+                    'result': self.index.get_result(row['doc_id'])
+                }
+                for row in sample
+            ]
         }
-        
-        for file in sample:
-            props = file.get('properties', {})
-            confidence = int(props.get('overall_confidence', 0))
-            
-            # Count confidence levels
-            if confidence >= self.config.confidence_thresholds.high:
-                validation_results['confidence_distribution']['high'] += 1
-            elif confidence >= self.config.confidence_thresholds.medium:
-                validation_results['confidence_distribution']['medium'] += 1
-            else:
-                validation_results['confidence_distribution']['low'] += 1
-            
-            # Count categories
-            for category in props.get('categories', '').split(','):
-                if category:
-                    validation_results['category_distribution'][category] = \
-                        validation_results['category_distribution'].get(category, 0) + 1
-            
-            # Add sample details
-            validation_results['samples'].append({
-                'id': file['id'],
-                'name': file['name'],
-                'confidence': confidence,
-                'categories': props.get('categories', '').split(','),
-                'summary': props.get('classification_summary')
-            })
-        
-        return validation_results
\ No newline at end of file
+
+    def _confidence_level(self, score: int) -> str:
+        """Map a confidence score to its level label using the configured thresholds."""
+        return CONFIDENCE_LEVELS[bisect_right(self._conf_breaks, score)]
\ No newline at end of file
@@ -0,0 +1,71 @@
+from typing import Dict
+import os
+import threading
+from functools import cached_property
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+import json_utils
+
+# Drive limits each custom property to 124 bytes of UTF-8 key plus value
+MAX_PROPERTY_BYTES = 124
+
+def classification_properties(classification: Dict, classified_at: str) -> Dict:
+    """
+    Build the Drive properties recording a classification.
+    
+    Only short summary fields are stored on the file; the full result is kept
+    in the local classification index.
+    """
+    categories = ','.join(c['name'] for c in classification['categories'])
+    max_bytes = MAX_PROPERTY_BYTES - len('categories')
+    encoded = categories.encode('utf-8')
+    if len(encoded) > max_bytes:
+        # Drop partial category names rather than storing a truncated one
+        categories = encoded[:max_bytes + 1].decode('utf-8', 'ignore').rpartition(',')[0]
+    
+    return {
+        'classified': 'true',
+        'classification_date': classified_at,
+        'overall_confidence': str(classification['overall_confidence']),
+        'categories': categories
+    }
+
+class ServiceBundle:
+    """Google credentials and API clients shared by discovery and processing.
+
+    Credentials and clients are created on first use, so requests that only
+    read the local index never touch the token file or the discovery documents.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @cached_property
+    def credentials(self) -> Credentials:
+        return self._load_credentials()
+
+    @cached_property
+    def drive_service(self):
+        return build('drive', 'v3', credentials=self.credentials)
+
+    @cached_property
+    def docs_service(self):
+        return build('docs', 'v1', credentials=self.credentials)
+
+    def _load_credentials(self) -> Credentials:
+        # Load credentials from the OAuth token file
+        token_path = os.getenv('GOOGLE_TOKEN_PATH', 'token.json')
+        if not os.path.exists(token_path):
+            raise FileNotFoundError(f"Google OAuth token not found at {token_path}")
+        
+        with open(token_path, 'rb') as token:
+            token_data = json_utils.loads(token.read())
+            return Credentials.from_authorized_user_info(token_data)
+
+    def http(self) -> AuthorizedHttp:
+        """Get the calling thread's HTTP client (httplib2 is not thread-safe)."""
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._local.http
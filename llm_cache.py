@@ -0,0 +1,25 @@
+from typing import Any, Optional
+import hashlib
+import diskcache
+
+class LLMCache:
+    def __init__(self, cache_dir: str, ttl: Optional[int] = None):
+        self.cache = diskcache.Cache(cache_dir)
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Build a cache key from everything that determines an LLM response."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None on a miss."""
+        return self.cache.get(key)
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        """Store value under key, expiring after ttl seconds (defaults to the cache TTL)."""
+        self.cache.set(key, value, expire=ttl if ttl is not None else self.ttl)
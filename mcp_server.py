@@ -3,10 +3,13 @@ from pydantic import BaseModel
 from goose_mcp import MCPServer, register_function
 import json
 import os
+from functools import cached_property
 from document_classifier import DocumentClassifier
 from document_discovery import DocumentDiscovery
 from document_processor import DocumentProcessor
 from config_loader import ConfigLoader
+from google_services import ServiceBundle
+from classification_index import ClassificationIndex
 
 class DiscoverRequest(BaseModel):
     folder_id: Optional[str] = None
@@ -17,6 +20,12 @@ class ClassifyRequest(BaseModel):
     document_ids: List[str]
     batch_size: Optional[int] = None
 
+class SubmitBatchRequest(BaseModel):
+    document_ids: List[str]
+
+class FetchBatchRequest(BaseModel):
+    batch_id: str
+
 class ReportRequest(BaseModel):
     output_format: Optional[str] = "markdown"
     include_details: Optional[bool] = True
@@ -28,9 +37,24 @@ class GDriveClassifierMCP(MCPServer):
     def __init__(self):
         super().__init__()
         self.config = ConfigLoader().load_config()
-        self.classifier = DocumentClassifier(self.config)
-        self.discovery = DocumentDiscovery(self.config)
-        self.processor = DocumentProcessor(self.config)
+        self.services = ServiceBundle()
+
+    # Components are built on first use so each request only pays for what it needs
+    @cached_property
+    def index(self) -> ClassificationIndex:
+        return ClassificationIndex(self.config.processing.index_path)
+
+    @cached_property
+    def discovery(self) -> DocumentDiscovery:
+        return DocumentDiscovery(self.config, self.services, self.index)
+
+    @cached_property
+    def processor(self) -> DocumentProcessor:
+        return DocumentProcessor(self.config, self.services, self.index)
+
+    @property
+    def classifier(self) -> DocumentClassifier:
+        return self.processor.classifier
 
     @register_function(
         "Discover documents in Google Drive that need classification",
@@ -49,13 +73,34 @@ class GDriveClassifierMCP(MCPServer):
         request_model=ClassifyRequest
     )
     async def classify_documents(self, request: ClassifyRequest):
+        threshold = self.config.processing.batch_api_threshold
+        if threshold and len(request.document_ids) > threshold:
+            batch = await self.processor.submit_classification_batch(request.document_ids)
+            return {"batch": batch}
+        
         batch_size = request.batch_size or self.config.processing.batch_size
-        results = self.processor.process_documents(
+        results = await self.processor.process_documents(
             document_ids=request.document_ids,
             batch_size=batch_size
         )
         return {"classifications": results}
 
+    @register_function(
+        "Submit documents for offline classification via the OpenAI Batch API",
+        request_model=SubmitBatchRequest
+    )
+    async def submit_classification_batch(self, request: SubmitBatchRequest):
+        batch = await self.processor.submit_classification_batch(request.document_ids)
+        return {"batch": batch}
+
+    @register_function(
+        "Fetch the results of an offline classification batch",
+        request_model=FetchBatchRequest
+    )
+    async def fetch_classification_batch(self, request: FetchBatchRequest):
+        batch = await self.processor.fetch_classification_batch(request.batch_id)
+        return {"batch": batch}
+
     @register_function(
         "Generate a classification report",
         request_model=ReportRequest